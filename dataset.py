@@ -191,7 +191,7 @@ class iNaturalistDataset():
         sorted_taxa = sorted(self.taxa, key=lambda x: x['key'])
         ii=0
         for d in sorted_taxa:
-            if d['leaf']==1 and (int(d['key']) in list(leaf_taxa_priors.keys())):
+            if d['leaf']==1 and (int(d['key']) in leaf_taxa_priors):
                 taxon_id_to_class_label[int(d['taxon_id'])] = ii#d['key']
                 ii+=1
         
@@ -40,114 +40,199 @@ taxa{
 
 from __future__ import absolute_import, division, print_function
 import argparse
-from collections import Counter
+from collections import Counter, defaultdict
+import concurrent.futures
 import datetime
 import json
 import os
 import random
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# created_at string -> datetime, shared by all datasets built in this process
+_DT_CACHE = {}
+
+def _parse_dt(created_at, _cache=_DT_CACHE):
+    """ Parse an identification `created_at` string, memoizing the result.
+    """
+    cat = _cache.get(created_at)
+    if cat is None:
+        try:
+            cat = datetime.datetime.strptime(created_at, '%Y-%m-%dT%H:%M:%S.%fZ')
+        except:
+            cat = datetime.datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S')
+        _cache[created_at] = cat
+    return cat
+
 class iNaturalistDataset():
 
     def __init__(self, observations=None, observation_photos=None,
-                 identifications=None, taxa=None, users=None):
+                 identifications=None, taxa=None, users=None, validate=True):
+        """ Pass `validate=False` for data that already went through `_sanity_check_data`
+        (e.g. the lists of another dataset).
+        """
 
-        self.observations = observations
         self.observation_photos = observation_photos
-        self.identifications = identifications
-        self.taxa = taxa
         self.users = users
 
-        self.taxon_id_to_taxon = {taxon['id'] : taxon for taxon in self.taxa}
-        self.ob_id_to_ob = {ob['id'] : ob for ob in self.observations}
-        self.iden_id_to_iden = {iden['id'] : iden for iden in self.identifications}
-
-        self._sanity_check_data()
-
-    def _sanity_check_data(self):
+        # The id -> object dicts are the primary storage, the `observations`,
+        # `identifications` and `taxa` lists are derived from them. They are
+        # built while checking the data.
+        if validate:
+            self._sanity_check_data(observations, identifications, taxa)
+        else:
+            self.observations = observations
+            self.identifications = identifications
+            self.taxa = taxa
+
+    @property
+    def observations(self):
+        return list(self.ob_id_to_ob.values())
+
+    @observations.setter
+    def observations(self, observations):
+        self.ob_id_to_ob = {ob['id'] : ob for ob in observations}
+
+    @property
+    def identifications(self):
+        return list(self.iden_id_to_iden.values())
+
+    @identifications.setter
+    def identifications(self, identifications):
+        self.iden_id_to_iden = {iden['id'] : iden for iden in identifications}
+        # Lazily built observation id -> identifications index, see `_index_idens_by_ob`
+        self._ob_id_to_idens = None
+
+    @property
+    def taxa(self):
+        return list(self.taxon_id_to_taxon.values())
+
+    @taxa.setter
+    def taxa(self, taxa):
+        self.taxon_id_to_taxon = {taxon['id'] : taxon for taxon in taxa}
+
+    def _sanity_check_data(self, observations, identifications, taxa):
         """ Ensure that all identifications have corresponding taxons.
+        Builds the id -> object dicts in the same passes over the data.
         """
 
+        obs_taxon_ids = set()
+        self.ob_id_to_ob = {}
+        for ob in observations:
+            self.ob_id_to_ob[ob['id']] = ob
+            obs_taxon_ids.add(ob['community_taxon_id'])
+
+        # Lets make sure that the observation ids are unique
+        assert len(self.ob_id_to_ob) == len(observations)
+
         # We could have some funky taxa (like `life`)
-        taxa_to_keep = []
-        obs_taxon_ids = [ob['community_taxon_id'] for ob in self.observations]
-        for taxon in self.taxa:
+        self.taxon_id_to_taxon = {}
+        for taxon in taxa:
             try:
                 taxon['rank_level'] = float(taxon['rank_level'])
                 if taxon['id'] in obs_taxon_ids:
-                    taxa_to_keep.append(taxon)
+                    self.taxon_id_to_taxon[taxon['id']] = taxon
             except:
                 print("WARNING: bad taxa? Non numeric rank level?")
                 print(taxon)
                 print()
                 continue
-        if len(taxa_to_keep) != len(self.taxa):
-            self.taxa = taxa_to_keep
-            self.taxon_id_to_taxon = {taxon['id'] : taxon for taxon in self.taxa}
-
-            idens_to_keep = [iden for iden in self.identifications if iden['taxon_id'] in self.taxon_id_to_taxon]
-            self.identifications = idens_to_keep
-            self.iden_id_to_iden = {iden['id'] : iden for iden in self.identifications}
 
-        for iden in self.identifications:
-            #assert iden['taxon_id'] in self.taxon_id_to_taxon
-            if iden['taxon_id'] not in self.taxon_id_to_taxon:
-                self.identifications.remove(iden)
-            #assert iden['observation_id'] in self.ob_id_to_ob
-            if iden['observation_id'] not in self.ob_id_to_ob:
-                self.identifications.remove(iden)
+        # Drop identifications that point at missing taxa or observations
+        num_idens = 0
+        self.iden_id_to_iden = {}
+        for iden in identifications:
+            if iden['taxon_id'] in self.taxon_id_to_taxon and iden['observation_id'] in self.ob_id_to_ob:
+                self.iden_id_to_iden[iden['id']] = iden
+                num_idens += 1
+        self._ob_id_to_idens = None
 
         # Lets make sure that identification ids are unique
-        iden_ids = [iden['id'] for iden in self.identifications]
-        assert len(iden_ids) == len(set(iden_ids))
-
-        # Lets make sure that the observation ids are unique
-        obs_ids = [ob['id'] for ob in self.observations]
-        assert len(obs_ids) == len(set(obs_ids))
-
+        assert len(self.iden_id_to_iden) == num_idens
 
-    def set_rank_level_as_leaf_level(self, leaf_rank_level=10):
-        """ Set a specific rank level to be the leaf level of the taxonomy.
-        Map all lower ranks up to that level. Modify the identifications to
-        reflect the mapping.
+    def _index_idens_by_ob(self):
+        """ Group the identifications by observation id. The index is cached
+        until the identifications are modified.
+        """
+        if self._ob_id_to_idens is None:
+            ob_id_to_idens = defaultdict(list)
+            for iden in self.iden_id_to_iden.values():
+                ob_id_to_idens[iden['observation_id']].append(iden)
+            # Missing observations should raise a KeyError, not add empty entries
+            ob_id_to_idens.default_factory = None
+            self._ob_id_to_idens = ob_id_to_idens
+        return self._ob_id_to_idens
+
+    def _keep_observations(self, ob_ids_to_keep):
+        """ Keep only the observations in `ob_ids_to_keep`, and their identifications.
+        """
+        ob_ids_to_remove = self.ob_id_to_ob.keys() - ob_ids_to_keep
+        for ob_id in ob_ids_to_remove:
+            del self.ob_id_to_ob[ob_id]
+
+        if self._ob_id_to_idens is not None:
+            # Only visit the identifications of the removed observations. The
+            # index stays valid since whole observations are removed.
+            for ob_id in ob_ids_to_remove:
+                for iden in self._ob_id_to_idens.pop(ob_id, []):
+                    del self.iden_id_to_iden[iden['id']]
+        else:
+            for iden_id, iden in list(self.iden_id_to_iden.items()):
+                if iden['observation_id'] not in self.ob_id_to_ob:
+                    del self.iden_id_to_iden[iden_id]
+
+    def _remap_taxa_to_rank_level(self, leaf_rank_level):
+        """ Map each taxon to its closest taxon (itself or an ancestor) at or
+        above `leaf_rank_level`.
+        Returns the mapping, the ids of the taxa below `leaf_rank_level` and the
+        ids of the taxa that could not be remapped.
         """
-
-        taxon_id_to_taxon = {taxon['id'] : taxon for taxon in self.taxa}
-        taxon_id_to_rank_level = {taxon['id'] : taxon['rank_level']
-                                  for taxon in self.taxa}
 
         # This will hold taxon ids at lower rank level to their
         # corresponding taxon at the `leaf_rank_level`
         taxon_id_to_remapped_taxon = {}
         taxa_ids_at_lower_rank = set()
         taxa_ids_not_remapped = set()
-        for taxon in self.taxa:
+        lower_rank_taxa = []
+        for taxon in self.taxon_id_to_taxon.values():
             if taxon['rank_level'] < leaf_rank_level:
                 taxa_ids_at_lower_rank.add(taxon['id'])
-                ancestry = taxon['ancestry']
-                try:
-                    ancestry_ids = ancestry.split('/')
-                except:
-                    print("WARNING: bad taxa? No ancestors found, but has a \
-                           lower rank level than the one specified?")
-                    print(taxon)
-                    print()
-                    taxa_ids_not_remapped.add(taxon['id'])
-                    continue
-
-                ancestry_ids.reverse()
-                found_higher_ancestor = False
-                for ancestor_id in ancestry_ids:
-                    ancestor_id = int(ancestor_id)
-                    if ancestor_id in taxon_id_to_rank_level:
-                        if taxon_id_to_rank_level[ancestor_id] >= leaf_rank_level:
-                            taxon_id_to_remapped_taxon[taxon['id']] = taxon_id_to_taxon[ancestor_id]
-                            found_higher_ancestor = True
-                            break
-                if not found_higher_ancestor:
-                    taxa_ids_not_remapped.add(taxon['id'])
+
+                # Parse the ancestry once, it is cached on the (shared) taxon
+                ancestry_ids = taxon.get('ancestry_ids')
+                if ancestry_ids is None:
+                    ancestry = taxon['ancestry']
+                    try:
+                        ancestry_ids = [int(ancestor_id) for ancestor_id in ancestry.split('/')]
+                    except:
+                        print("WARNING: bad taxa? No ancestors found, but has a \
+                               lower rank level than the one specified?")
+                        print(taxon)
+                        print()
+                        taxa_ids_not_remapped.add(taxon['id'])
+                        continue
+                    taxon['ancestry_ids'] = ancestry_ids
+
+                lower_rank_taxa.append((taxon, ancestry_ids))
             else:
                 taxon_id_to_remapped_taxon[taxon['id']] = taxon
 
+        # Remap the shallower taxa first. The closest ancestor that has already
+        # been remapped then gives the answer for its descendants, instead of
+        # walking every descendant's ancestry up to the `leaf_rank_level`.
+        lower_rank_taxa.sort(key=lambda x: len(x[1]))
+        for taxon, ancestry_ids in lower_rank_taxa:
+            for ancestor_id in reversed(ancestry_ids):
+                remapped_taxon = taxon_id_to_remapped_taxon.get(ancestor_id)
+                if remapped_taxon is not None:
+                    taxon_id_to_remapped_taxon[taxon['id']] = remapped_taxon
+                    break
+            else:
+                taxa_ids_not_remapped.add(taxon['id'])
+
         # Some taxa might not have been remapped
         if len(taxa_ids_not_remapped) > 0:
             print("WARNING: Found %d taxa that could not be remapped to the rank level of %d" % (len(taxa_ids_not_remapped), leaf_rank_level))
@@ -155,124 +240,105 @@ class iNaturalistDataset():
                 print(self.taxon_id_to_taxon[taxon_id])
             print()
 
-            taxa_to_keep = [taxon for taxon in self.taxa if taxon['id'] not in taxa_ids_not_remapped]
-            self.taxa = taxa_to_keep
-            self.taxon_id_to_taxon = {taxon['id'] : taxon for taxon in self.taxa}
+        return taxon_id_to_remapped_taxon, taxa_ids_at_lower_rank, taxa_ids_not_remapped
 
-            idens_to_keep = [iden for iden in self.identifications if iden['taxon_id'] not in taxa_ids_not_remapped]
-            self.identifications = idens_to_keep
+    def set_rank_level_as_leaf_level(self, leaf_rank_level=10):
+        """ Set a specific rank level to be the leaf level of the taxonomy.
+        Map all lower ranks up to that level. Modify the identifications to
+        reflect the mapping.
+        """
 
-        # Remap the identifications
-        for identification in self.identifications:
-            if identification['taxon_id'] in taxa_ids_at_lower_rank:
-                identification['taxon_id'] = taxon_id_to_remapped_taxon[identification['taxon_id']]['id']
-            else:
-                if identification['taxon_id'] not in taxon_id_to_rank_level.keys():
-                    self.identifications.remove(identification)
-                    #assert taxon_id_to_rank_level[identification['taxon_id']] >= leaf_rank_level
-
-        # Delete the remapped taxons
-        taxa_to_keep = []
-        for taxa in self.taxa:
-            if taxa['id'] not in taxa_ids_at_lower_rank:
-                taxa_to_keep.append(taxa)
-        self.taxa = taxa_to_keep
-        self.taxon_id_to_taxon = {taxon['id'] : taxon for taxon in self.taxa}
+        taxon_id_to_remapped_taxon, taxa_ids_at_lower_rank, _ = self._remap_taxa_to_rank_level(leaf_rank_level)
+
+        # Remap the identifications. Identifications whose taxon is missing or
+        # could not be remapped have no entry in `taxon_id_to_remapped_taxon`
+        # and are dropped in the same pass.
+        idens_to_keep = {}
+        for iden_id, identification in self.iden_id_to_iden.items():
+            remapped_taxon = taxon_id_to_remapped_taxon.get(identification['taxon_id'])
+            if remapped_taxon is not None:
+                identification['taxon_id'] = remapped_taxon['id']
+                idens_to_keep[iden_id] = identification
+        self.iden_id_to_iden = idens_to_keep
+        self._ob_id_to_idens = None
+
+        # Delete the remapped taxons (and the ones that could not be remapped)
+        for taxon_id in taxa_ids_at_lower_rank:
+            del self.taxon_id_to_taxon[taxon_id]
 
     def create_flat_taxonomy(self, leaf_rank_level='10'):
         """ Remove taxa not at this rank level. Remove identifications not
         at this rank level.
         """
 
-        taxa_to_keep = [taxon for taxon in self.taxa if taxon['rank_level'] == leaf_rank_level]
-        self.taxa = taxa_to_keep
-        self.taxon_id_to_taxon = {taxon['id'] : taxon for taxon in self.taxa}
+        self.taxon_id_to_taxon = {taxon_id : taxon for taxon_id, taxon in self.taxon_id_to_taxon.items()
+                                  if taxon['rank_level'] == leaf_rank_level}
 
         # Filter the identifications
-        idens_to_keep = [iden for iden in self.identifications if iden['taxon_id'] in self.taxon_id_to_taxon]
-        self.identifications = idens_to_keep
-        self.iden_id_to_iden = {iden['id'] : iden for iden in self.identifications}
+        self.iden_id_to_iden = {iden_id : iden for iden_id, iden in self.iden_id_to_iden.items()
+                                if iden['taxon_id'] in self.taxon_id_to_taxon}
+        self._ob_id_to_idens = None
 
 
     def remove_non_active_taxa(self):
         """ Remove non active taxa and identifications.
         """
 
-        non_active_taxa_ids = set([taxon['id'] for taxon in self.taxa if taxon['is_active'] != True])
+        non_active_taxa_ids = set([taxon['id'] for taxon in self.taxon_id_to_taxon.values() if taxon['is_active'] != True])
 
         # Filter the taxa
-        taxa_to_keep = [taxon for taxon in self.taxa if taxon['id'] not in non_active_taxa_ids]
-        self.taxa = taxa_to_keep
-        self.taxon_id_to_taxon = {taxon['id'] : taxon for taxon in self.taxa}
+        for taxon_id in non_active_taxa_ids:
+            del self.taxon_id_to_taxon[taxon_id]
 
         # Filter the identifications
-        idens_to_keep = [iden for iden in self.identifications if iden['taxon_id'] not in non_active_taxa_ids]
-        self.identifications = idens_to_keep
-        self.iden_id_to_iden = {iden['id'] : iden for iden in self.identifications}
+        self.iden_id_to_iden = {iden_id : iden for iden_id, iden in self.iden_id_to_iden.items()
+                                if iden['taxon_id'] not in non_active_taxa_ids}
+        self._ob_id_to_idens = None
 
     def keep_specific_observations(self, observation_ids_to_keep):
         """ Keep only the specified observations.
         """
-        observation_ids_to_keep = set(observation_ids_to_keep)
-        obs_to_keep = [ob for ob in self.observations if ob['id'] in observation_ids_to_keep]
-        self.observations = obs_to_keep
-        self.ob_id_to_ob = {ob['id'] : ob for ob in self.observations}
-
-        idens_to_keep = [iden for iden in self.identifications if iden['observation_id'] in self.ob_id_to_ob]
-        self.identifications = idens_to_keep
-        self.iden_id_to_iden = {iden['id'] : iden for iden in self.identifications}
+        self._keep_observations(set(observation_ids_to_keep))
 
     def keep_one_identification_per_user_per_observation(self, keep_index=0):
         """ Select one identification per user per observation.
         keep_index = 0 for the first identification, -1 for the last identification.
         """
 
-        # group the identifications by observation ids
-        ob_id_to_idens = {ob['id'] : [] for ob in self.observations}
-        for iden in self.identifications:
-            ob_id_to_idens[iden['observation_id']].append(iden)
-
-        iden_ids_to_keep = set()
-        for ob_id, idens in ob_id_to_idens.items():
-            # group the identifications by user and process them individually
-            user_id_to_idens = {}
-            for identification in idens:
-                user_id = identification['user_id']
-                user_id_to_idens.setdefault(user_id, [])
-                user_id_to_idens[user_id].append(identification)
-
-            for user_id in user_id_to_idens:
-                user_idens = user_id_to_idens[user_id]
-
-                # Sort the identifications by time
-                for identification in user_idens:
-                    created_at = identification['created_at']
-                    try:
-                        cat = datetime.datetime.strptime(created_at, '%Y-%m-%dT%H:%M:%S.%fZ')
-                    except:
-                        cat = datetime.datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S')
-                    identification['time'] = cat
-                user_idens.sort(key=lambda x: x['time'])
-
-                iden_ids_to_keep.add(user_idens[keep_index]['id'])
-
-        idens_to_keep = [iden for iden in self.identifications if iden['id'] in iden_ids_to_keep]
-        self.identifications = idens_to_keep
-        self.iden_id_to_iden = {iden['id'] : iden for iden in self.identifications}
+        assert keep_index in (0, -1)
+        keep_first = keep_index == 0
+
+        # Track the earliest (or latest) identification for each (observation, user)
+        # pair in one pass. Ties go to the identification that comes first (or
+        # last), the same as a stable sort by time would give.
+        ob_user_id_to_kept = {}
+        for iden_id, identification in self.iden_id_to_iden.items():
+            time = _parse_dt(identification['created_at'])
+            ob_user_id = (identification['observation_id'], identification['user_id'])
+            kept = ob_user_id_to_kept.get(ob_user_id)
+            if kept is None or (time < kept[0] if keep_first else time >= kept[0]):
+                ob_user_id_to_kept[ob_user_id] = (time, iden_id)
+        iden_ids_to_keep = {iden_id for _, iden_id in ob_user_id_to_kept.values()}
+
+        self.iden_id_to_iden = {iden_id : iden for iden_id, iden in self.iden_id_to_iden.items()
+                                if iden_id in iden_ids_to_keep}
+        self._ob_id_to_idens = None
 
     def keep_current_identifications(self):
         """ Keep only the current identifications.
         """
 
-        idens_to_keep = [iden for iden in self.identifications if iden['current'] == True]
-        self.identifications = idens_to_keep
-        self.iden_id_to_iden = {iden['id'] : iden for iden in self.identifications}
+        self.iden_id_to_iden = {iden_id : iden for iden_id, iden in self.iden_id_to_iden.items()
+                                if iden['current'] == True}
+        self._ob_id_to_idens = None
 
-        # Lets make sure that each identification for each observation is
-        # coming from a unique worker.
-        ob_id_to_idens = {ob['id'] : [] for ob in self.observations}
-        for iden in self.identifications:
-            ob_id_to_idens[iden['observation_id']].append(iden)
+        self._check_one_identification_per_user()
+
+    def _check_one_identification_per_user(self):
+        """ Lets make sure that each identification for each observation is
+        coming from a unique worker.
+        """
+        ob_id_to_idens = self._index_idens_by_ob()
         for ob_id, idens in ob_id_to_idens.items():
             if len(set([iden['user_id'] for iden in idens])) != len(idens):
                 print("ERROR: observation %s has multiple identifications from the same user" % (ob_id,))
@@ -282,54 +348,90 @@ class iNaturalistDataset():
         """ Remove observations that don't have any photos.
         """
 
-        ob_ids_with_urls = set([ob_image['observation_id'] for ob_image in self.observation_photos])
-        obs_to_keep = [ob for ob in self.observations if ob['id'] in ob_ids_with_urls]
-        self.observations = obs_to_keep
-        self.ob_id_to_ob = {ob['id'] : ob for ob in self.observations}
-
-        idens_to_keep = [iden for iden in self.identifications if iden['observation_id'] in self.ob_id_to_ob]
-        self.identifications = idens_to_keep
-        self.iden_id_to_iden = {iden['id'] : iden for iden in self.identifications}
+        ob_ids_with_urls = {ob_image['observation_id'] for ob_image in self.observation_photos}
+        self._keep_observations(ob_ids_with_urls)
 
     def enforce_min_identifications(self, min_identifications=1):
         """ Remove observations that have less than `min_identifications`.
         """
 
-        ob_id_to_idens = {ob['id'] : [] for ob in self.observations}
-        for iden in self.identifications:
-            ob_id_to_idens[iden['observation_id']].append(iden)
+        ob_id_to_idens = self._index_idens_by_ob()
 
         ob_ids_to_keep = set()
-        for ob_id, idens in ob_id_to_idens.items():
-            if len(idens) >= min_identifications:
+        for ob_id in self.ob_id_to_ob:
+            if len(ob_id_to_idens.get(ob_id, [])) >= min_identifications:
                 ob_ids_to_keep.add(ob_id)
 
-        obs_to_keep = [ob for ob in self.observations if ob['id'] in ob_ids_to_keep]
-        self.observations = obs_to_keep
-        self.ob_id_to_ob = {ob['id'] : ob for ob in self.observations}
-
-        idens_to_keep = [iden for iden in self.identifications if iden['observation_id'] in self.ob_id_to_ob]
-        self.identifications = idens_to_keep
-        self.iden_id_to_iden = {iden['id'] : iden for iden in self.identifications}
+        self._keep_observations(ob_ids_to_keep)
 
     def enforce_max_observations(self, max_observations=None):
         if max_observations is None:
             return
 
-        if max_observations >= len(self.observations):
+        if max_observations >= len(self.ob_id_to_ob):
             return
 
         # Randomly pick observations to keep
-        ob_ids = [ob['id'] for ob in self.observations]
-        ob_ids_to_keep = random.sample(ob_ids, max_observations)
-        obs_to_keep = [ob for ob in self.observations if ob['id'] in ob_ids_to_keep]
-        self.observations = obs_to_keep
-        self.ob_id_to_ob = {ob['id'] : ob for ob in self.observations}
-
-        idens_to_keep = [iden for iden in self.identifications if iden['observation_id'] in self.ob_id_to_ob]
-        self.identifications = idens_to_keep
-        self.iden_id_to_iden = {iden['id'] : iden for iden in self.identifications}
+        ob_ids = list(self.ob_id_to_ob)
+        ob_ids_to_keep = set(random.sample(ob_ids, max_observations))
+        self._keep_observations(ob_ids_to_keep)
+
+    def apply_pipeline(self, leaf_rank_level=10, observation_ids_to_keep=None, keep_current=False,
+                       require_photos=True, keep_index=None, min_identifications=1, max_observations=None):
+        """ Run the filtering steps used by `main` with a single pass over the identifications.
+        This is equivalent to calling `set_rank_level_as_leaf_level`, `create_flat_taxonomy`,
+        `remove_non_active_taxa`, `keep_specific_observations` (if `observation_ids_to_keep` is given),
+        `keep_current_identifications` (if `keep_current`), `remove_obs_with_no_photos` (if `require_photos`),
+        `keep_one_identification_per_user_per_observation` (if `keep_index` is not None),
+        `enforce_min_identifications` and `enforce_max_observations`, in that order.
+        Pass `leaf_rank_level=None` to skip the first three steps for data whose taxonomy
+        was already flattened (see `_prepare_shared`).
+        """
 
+        taxon_id_to_remapped_taxon = None
+        if leaf_rank_level is not None:
+            taxon_id_to_remapped_taxon, _, _ = self._remap_taxa_to_rank_level(leaf_rank_level)
+
+            # Taxa that survive the remapping, flattening and active checks
+            self.taxon_id_to_taxon = {taxon_id : taxon for taxon_id, taxon in self.taxon_id_to_taxon.items()
+                                      if taxon['rank_level'] == leaf_rank_level and taxon['is_active'] == True}
+
+        # Observations that survive the observation level filters
+        ob_ids_to_keep = self.ob_id_to_ob.keys()
+        if observation_ids_to_keep is not None:
+            ob_ids_to_keep = ob_ids_to_keep & set(observation_ids_to_keep)
+        if require_photos:
+            ob_ids_to_keep = ob_ids_to_keep & {ob_image['observation_id'] for ob_image in self.observation_photos}
+        for ob_id in self.ob_id_to_ob.keys() - ob_ids_to_keep:
+            del self.ob_id_to_ob[ob_id]
+
+        iden_id_to_iden = self.iden_id_to_iden
+        if taxon_id_to_remapped_taxon is not None:
+            # Remap the identifications, dropping those that can't be remapped
+            iden_id_to_iden = {}
+            for iden_id, iden in self.iden_id_to_iden.items():
+                remapped_taxon = taxon_id_to_remapped_taxon.get(iden['taxon_id'])
+                if remapped_taxon is not None:
+                    iden['taxon_id'] = remapped_taxon['id']
+                    iden_id_to_iden[iden_id] = iden
+
+        # Evaluate the combined taxon, observation and current check once per identification
+        taxon_id_to_taxon = self.taxon_id_to_taxon
+        ob_id_to_ob = self.ob_id_to_ob
+        self.iden_id_to_iden = {iden_id : iden for iden_id, iden in iden_id_to_iden.items()
+                                if iden['taxon_id'] in taxon_id_to_taxon
+                                and iden['observation_id'] in ob_id_to_ob
+                                and (not keep_current or iden['current'] == True)}
+        self._ob_id_to_idens = None
+
+        if keep_current:
+            self._check_one_identification_per_user()
+
+        if keep_index is not None:
+            self.keep_one_identification_per_user_per_observation(keep_index=keep_index)
+
+        self.enforce_min_identifications(min_identifications=min_identifications)
+        self.enforce_max_observations(max_observations)
 
     def estimate_taxa_priors(self, include_taxa_ids=None):
         """ Use the current identifications and the corresponding `community_taxon_id`
@@ -338,17 +440,17 @@ class iNaturalistDataset():
         total number of taxa.
         """
 
-        taxon_id_working_set = set([iden['taxon_id'] for iden in self.identifications])
+        taxon_id_working_set = {iden['taxon_id'] for iden in self.iden_id_to_iden.values()}
         if include_taxa_ids is not None:
             taxon_id_working_set.update(include_taxa_ids)
-        community_taxon_ids = []
-        for iden in self.identifications:
-            ob = self.ob_id_to_ob[iden['observation_id']]
-            cid = ob['community_taxon_id']
-            if cid is not None:
-                if cid in taxon_id_working_set:
-                    community_taxon_ids.append(cid)
-        taxon_counts = Counter(community_taxon_ids)
+
+        # Counter does the counting in C, so feed it the ids directly rather
+        # than building an intermediate list
+        ob_id_to_ob = self.ob_id_to_ob
+        community_taxon_ids = (ob_id_to_ob[iden['observation_id']]['community_taxon_id']
+                               for iden in self.iden_id_to_iden.values())
+        taxon_counts = Counter(cid for cid in community_taxon_ids
+                               if cid is not None and cid in taxon_id_working_set)
 
         # fill in any missing taxa
         for taxon_id in taxon_id_working_set:
@@ -419,6 +521,62 @@ class iNaturalistDataset():
 
         return dataset
 
+def load_json(path):
+    """ Load a json file, using orjson when it is available.
+    """
+    with open(path, 'rb') as f:
+        if orjson is not None:
+            return orjson.loads(f.read())
+        return json.load(f)
+
+def save_json(obj, path):
+    """ Save `obj` to a json file, using orjson when it is available.
+    """
+    if orjson is not None:
+        with open(path, 'wb') as f:
+            # the datasets are keyed by (possibly integer) ids
+            f.write(orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS))
+    else:
+        with open(path, 'w') as f:
+            json.dump(obj, f)
+
+def _prepare_shared(observations, observation_photos, identifications, taxa, users, leaf_rank_level=10):
+    """ Check the data and flatten the taxonomy to `leaf_rank_level`. These steps are the
+    same for all of the datasets built in `main`, so they are only done once.
+    Returns the remaining observations, identifications and taxa.
+    """
+    inat = iNaturalistDataset(observations, observation_photos, identifications, taxa, users)
+    inat.set_rank_level_as_leaf_level(leaf_rank_level=leaf_rank_level)
+    inat.create_flat_taxonomy(leaf_rank_level=leaf_rank_level)
+    inat.remove_non_active_taxa()
+    return inat.observations, inat.identifications, inat.taxa
+
+# The `build_*` functions expect data that went through `_prepare_shared`.
+
+def build_ob_inat(observations, observation_photos, identifications, taxa, users, max_observations=None):
+    """ Build the observation label prediction dataset.
+    """
+    ob_inat = iNaturalistDataset(observations, observation_photos, identifications, taxa, users, validate=False)
+    ob_inat.apply_pipeline(leaf_rank_level=None, keep_current=True, require_photos=True,
+                           min_identifications=2, max_observations=max_observations)
+    return ob_inat
+
+def build_worker_inat(observations, observation_photos, identifications, taxa, users, ob_ids, max_observations=None):
+    """ Build the worker skill prediction dataset, restricted to the observations in `ob_ids`.
+    """
+    worker_inat = iNaturalistDataset(observations, observation_photos, identifications, taxa, users, validate=False)
+    worker_inat.apply_pipeline(leaf_rank_level=None, observation_ids_to_keep=ob_ids, require_photos=True,
+                               keep_index=0, min_identifications=2, max_observations=max_observations)
+    return worker_inat
+
+def build_test_inat(observations, observation_photos, identifications, taxa, users, max_observations=None):
+    """ Build the "testing" dataset.
+    """
+    inat = iNaturalistDataset(observations, observation_photos, identifications, taxa, users, validate=False)
+    inat.apply_pipeline(leaf_rank_level=None, keep_current=True, require_photos=True,
+                        min_identifications=1, max_observations=max_observations)
+    return inat
+
 def parse_args():
 
     parser = argparse.ArgumentParser(description='Create a dataset for crowdsourcing.')
@@ -449,49 +607,58 @@ def main():
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    with open(os.path.join(archive_dir, 'observations.json')) as f:
-        observations = json.load(f)
-
-    with open(os.path.join(archive_dir, 'observation_photos.json')) as f:
-        observation_photos = json.load(f)
-
-    with open(os.path.join(archive_dir, 'identifications.json')) as f:
-        identifications = json.load(f)
-
-    with open(os.path.join(archive_dir, 'taxa.json')) as f:
-        taxa = json.load(f)
-
-    with open(os.path.join(archive_dir, 'users.json')) as f:
-        users = json.load(f)
+    observations = load_json(os.path.join(archive_dir, 'observations.json'))
+    observation_photos = load_json(os.path.join(archive_dir, 'observation_photos.json'))
+    identifications = load_json(os.path.join(archive_dir, 'identifications.json'))
+    taxa = load_json(os.path.join(archive_dir, 'taxa.json'))
+    users = load_json(os.path.join(archive_dir, 'users.json'))
     
     for d in identifications:
         for k, v in d.items():
             if v == 't':
                 d[k] = True
-    
+
+    # Use integer ids everywhere, they are faster to hash and compare than
+    # the strings in the archive.
+    for ob in observations:
+        ob['id'] = int(ob['id'])
+        ob['user_id'] = int(ob['user_id'])
+        if ob['community_taxon_id'] is not None:
+            ob['community_taxon_id'] = int(ob['community_taxon_id'])
+    for ob_image in observation_photos:
+        ob_image['observation_id'] = int(ob_image['observation_id'])
+    for iden in identifications:
+        iden['id'] = int(iden['id'])
+        iden['observation_id'] = int(iden['observation_id'])
+        iden['taxon_id'] = int(iden['taxon_id'])
+        iden['user_id'] = int(iden['user_id'])
+    for taxon in taxa:
+        taxon['id'] = int(taxon['id'])
+        if taxon['iconic_taxon_id'] is not None:
+            taxon['iconic_taxon_id'] = int(taxon['iconic_taxon_id'])
+    users = [int(user_id) for user_id in users]
+
     taxa = [d for d in taxa if (d['is_active'] == True and d['ancestry'] != None) ]
     
-    # Build the observation label prediction dataset
-    ob_inat = iNaturalistDataset(observations, observation_photos, identifications, taxa, users)
-    ob_inat.set_rank_level_as_leaf_level(leaf_rank_level=10)
-    ob_inat.create_flat_taxonomy(leaf_rank_level=10)
-    ob_inat.remove_non_active_taxa()
-    ob_inat.keep_current_identifications()
-    ob_inat.remove_obs_with_no_photos()
-    ob_inat.enforce_min_identifications(min_identifications=2)
-    ob_inat.enforce_max_observations(args.max_observations)
-    ob_ids = [ob['id'] for ob in ob_inat.observations] # Make sure the worker dataset has the same obs
-
-    # Build the worker skill prediction dataset
-    worker_inat = iNaturalistDataset(observations, observation_photos, identifications, taxa, users)
-    worker_inat.set_rank_level_as_leaf_level(leaf_rank_level=10)
-    worker_inat.create_flat_taxonomy(leaf_rank_level=10)
-    worker_inat.remove_non_active_taxa()
-    worker_inat.keep_specific_observations(ob_ids)
-    worker_inat.keep_one_identification_per_user_per_observation(keep_index=0)
-    worker_inat.remove_obs_with_no_photos()
-    worker_inat.enforce_min_identifications(min_identifications=2)
-    worker_inat.enforce_max_observations(args.max_observations)
+    # Build the three datasets in separate processes. The worker skill dataset
+    # needs the observations of the label prediction dataset, so it starts once
+    # that one is done, while the testing dataset is built alongside both.
+    # Check the data and flatten the taxonomy once, rather than in each of the dataset builds.
+    observations, identifications, taxa = _prepare_shared(observations, observation_photos, identifications,
+                                                          taxa, users, leaf_rank_level=10)
+    inputs = (observations, observation_photos, identifications, taxa, users)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=3) as executor:
+        ob_inat_future = executor.submit(build_ob_inat, *inputs, max_observations=args.max_observations)
+        inat_future = executor.submit(build_test_inat, *inputs, max_observations=args.max_observations)
+
+        ob_inat = ob_inat_future.result()
+        ob_ids = [ob['id'] for ob in ob_inat.observations] # Make sure the worker dataset has the same obs
+        worker_inat_future = executor.submit(build_worker_inat, *inputs, ob_ids=ob_ids,
+                                             max_observations=args.max_observations)
+
+        worker_inat = worker_inat_future.result()
+        inat = inat_future.result()
 
     # We want to reconcile the taxa priors between the image label and worker skill dataset
     # This way the labels will match up
@@ -501,31 +668,20 @@ def main():
     ob_label_pred_dataset = ob_inat.create_dataset(taxa_priors)
 
     label_pred_output_path = os.path.join(output_dir, 'observation_label_pred_dataset.json')
-    with open(label_pred_output_path, 'w') as f:
-        json.dump(ob_label_pred_dataset, f)
+    save_json(ob_label_pred_dataset, label_pred_output_path)
 
     #worker_skill_taxa_priors = worker_inat.estimate_taxa_priors(include_taxa_ids=taxon_id_working_set)
     worker_skill_pred_dataset = worker_inat.create_dataset(taxa_priors)
 
     worker_skill_pred_output_path = os.path.join(output_dir, 'worker_skill_pred_dataset.json')
-    with open(worker_skill_pred_output_path, 'w') as f:
-        json.dump(worker_skill_pred_dataset, f)
+    save_json(worker_skill_pred_dataset, worker_skill_pred_output_path)
 
-    # Build a "testing" dataset.
-    inat = iNaturalistDataset(observations, observation_photos, identifications, taxa, users)
-    inat.set_rank_level_as_leaf_level(leaf_rank_level=10)
-    inat.create_flat_taxonomy(leaf_rank_level=10)
-    inat.remove_non_active_taxa()
-    inat.keep_current_identifications()
-    inat.remove_obs_with_no_photos()
-    inat.enforce_min_identifications(min_identifications=1)
-    inat.enforce_max_observations(args.max_observations)
+    # Save the "testing" dataset.
     taxa_priors = inat.estimate_taxa_priors()
     test_dataset = inat.create_dataset(taxa_priors)
 
     test_output_path = os.path.join(output_dir, 'test_dataset.json')
-    with open(test_output_path, 'w') as f:
-        json.dump(test_dataset, f)
+    save_json(test_dataset, test_output_path)
 
 if __name__ == '__main__':
     main()
@@ -24,180 +24,263 @@ taxonomy.csv
 
 from __future__ import absolute_import, division, print_function
 import argparse
-from collections import Counter
+from collections import Counter, defaultdict
 import datetime
 import csv
 import json
 import os
 import random
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _csv_bool(value):
+    return value == 'true'
+
+# Converters for the typed columns of the csv files, the other columns are kept as strings.
+TAXONOMY_COLUMN_TYPES = {'taxon_id' : int, 'prob' : float, 'leaf' : int}
+IDENTIFICATION_COLUMN_TYPES = {'id' : int, 'taxon_id' : int, 'user_id' : int,
+                               'observation_id' : int, 'current' : _csv_bool}
+
+def read_csv(path, column_types):
+    """ Yield the rows of a csv file as dicts. The columns in `column_types` are converted
+    with the corresponding function and empty values are converted to None.
+    """
+    with open(path, 'r', newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        # Look up the converters once per column rather than once per cell
+        columns = [(name, column_types.get(name)) for name in header]
+        for values in reader:
+            yield {name : (None if value == '' else convert(value) if convert is not None else value)
+                   for (name, convert), value in zip(columns, values)}
+
+# created_at string -> datetime, shared by all of the datasets
+_DT_CACHE = {}
+
+def _parse_dt(created_at, _cache=_DT_CACHE):
+    """ Parse an identification `created_at` string, memoizing the result.
+    """
+    cat = _cache.get(created_at)
+    if cat is None:
+        try:
+            cat = datetime.datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S %Z')
+        except:
+            try:
+                cat = datetime.datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S.%f')
+            except:
+                cat = datetime.datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S')
+        _cache[created_at] = cat
+    return cat
+
+def observation_stubs(observation_ids):
+    """ Yield placeholder observations, the csv files don't have any observation data.
+    """
+    for observation_id in observation_ids:
+        yield {'id': observation_id,
+               'user_id': None,
+               'community_taxon_id': None,
+               'quality_grade': None,
+               'created_at': None,
+               'latitude': None,
+               'longitude': None}
+
+def observation_photo_stubs(observation_ids):
+    """ Yield placeholder observation photos.
+    """
+    for observation_id in observation_ids:
+        yield {'id': observation_id, 'native_original_image_url': None}
+
 class iNaturalistDataset():
 
     def __init__(self, observations=None, observation_photos=None,
-                 identifications=None, taxa=None, users=None):
+                 identifications=None, taxa=None, users=None, validate=True):
+        """ Pass `validate=False` for data that already went through `_sanity_check_data`
+        (e.g. the identifications of another dataset).
+        """
 
+        # The id -> object dicts are the primary storage for the observations and
+        # identifications, the lists are derived from them. `observations` can be
+        # any iterable (e.g. a generator of stubs).
         self.observations = observations
         self.observation_photos = observation_photos
-        self.identifications = identifications
         self.taxa = taxa
         self.users = users
 
         self.taxon_id_to_taxon = {taxon['taxon_id'] : taxon for taxon in self.taxa}
-        self.ob_id_to_ob = {ob['id'] : ob for ob in self.observations}
-        self.iden_id_to_iden = {iden['id'] : iden for iden in self.identifications}
-        
-        self._sanity_check_data()
 
-    def _sanity_check_data(self):
-        """ Ensure that all identifications have corresponding taxons.
+        if validate:
+            self._sanity_check_data(identifications)
+        else:
+            self.identifications = identifications
+
+    @property
+    def observations(self):
+        return list(self.ob_id_to_ob.values())
+
+    @observations.setter
+    def observations(self, observations):
+        self.ob_id_to_ob = {}
+        for ob in observations:
+            # Lets make sure that the observation ids are unique
+            assert ob['id'] not in self.ob_id_to_ob
+            self.ob_id_to_ob[ob['id']] = ob
+
+    @property
+    def identifications(self):
+        return list(self.iden_id_to_iden.values())
+
+    @identifications.setter
+    def identifications(self, identifications):
+        self.iden_id_to_iden = {iden['id'] : iden for iden in identifications}
+        # Lazily built observation id -> identifications index, see `_index_idens_by_ob`
+        self._ob_id_to_idens = None
+
+    def _sanity_check_data(self, identifications):
+        """ Ensure that all identifications have corresponding taxons and observations.
+        Builds the id -> identification dict in the same pass over the data.
         """
-        for iden in self.identifications:
-            assert int(iden['taxon_id']) in self.taxon_id_to_taxon
-            assert iden['observation_id'] in self.ob_id_to_ob
-        
+        # Lets keep only the identifications whose taxon and observation exist
+        taxon_ids = self.taxon_id_to_taxon.keys()
+        ob_ids = self.ob_id_to_ob.keys()
+        identifications = [iden for iden in identifications
+                           if iden['taxon_id'] in taxon_ids and iden['observation_id'] in ob_ids]
+        self.identifications = identifications
+
         # Lets make sure that identification ids are unique
-        iden_ids = [iden['id'] for iden in self.identifications]
-        assert len(iden_ids) == len(set(iden_ids))
+        assert len(self.iden_id_to_iden) == len(identifications)
 
-        # Lets make sure that the observation ids are unique
-        obs_ids = [ob['id'] for ob in self.observations]
-        assert len(obs_ids) == len(set(obs_ids))
+    def _index_idens_by_ob(self):
+        """ Group the identifications by observation id. The index is cached
+        until the identifications are modified.
+        """
+        if self._ob_id_to_idens is None:
+            ob_id_to_idens = defaultdict(list)
+            for iden in self.iden_id_to_iden.values():
+                ob_id_to_idens[iden['observation_id']].append(iden)
+            # Missing observations should raise a KeyError, not add empty entries
+            ob_id_to_idens.default_factory = None
+            self._ob_id_to_idens = ob_id_to_idens
+        return self._ob_id_to_idens
+
+    def _check_one_identification_per_user(self):
+        """ Lets make sure that each identification for each observation is
+        coming from a unique worker.
+        """
+        ob_id_to_idens = self._index_idens_by_ob()
+        for ob_id, idens in ob_id_to_idens.items():
+            if len(set([iden['user_id'] for iden in idens])) != len(idens):
+                print("ERROR: observation %s has multiple identifications from the same user" % (ob_id,))
+                assert False
+
+    def _keep_observations(self, ob_ids_to_keep):
+        """ Keep only the observations in `ob_ids_to_keep`, and their identifications.
+        """
+        ob_ids_to_remove = self.ob_id_to_ob.keys() - ob_ids_to_keep
+        for ob_id in ob_ids_to_remove:
+            del self.ob_id_to_ob[ob_id]
+
+        if self._ob_id_to_idens is not None:
+            # Only visit the identifications of the removed observations. The
+            # index stays valid since whole observations are removed.
+            for ob_id in ob_ids_to_remove:
+                for iden in self._ob_id_to_idens.pop(ob_id, []):
+                    del self.iden_id_to_iden[iden['id']]
+        else:
+            for iden_id, iden in list(self.iden_id_to_iden.items()):
+                if iden['observation_id'] not in self.ob_id_to_ob:
+                    del self.iden_id_to_iden[iden_id]
     
     def keep_specific_observations(self, observation_ids_to_keep):
         """ Keep only the specified observations.
         """
-        observation_ids_to_keep = set(observation_ids_to_keep)
-        obs_to_keep = [ob for ob in self.observations if ob['id'] in observation_ids_to_keep]
-        self.observations = obs_to_keep
-        self.ob_id_to_ob = {ob['id'] : ob for ob in self.observations}
-
-        idens_to_keep = [iden for iden in self.identifications if iden['observation_id'] in self.ob_id_to_ob]
-        self.identifications = idens_to_keep
-        self.iden_id_to_iden = {iden['id'] : iden for iden in self.identifications}
+        if not isinstance(observation_ids_to_keep, (set, frozenset)):
+            observation_ids_to_keep = frozenset(observation_ids_to_keep)
+        self._keep_observations(observation_ids_to_keep)
 
     def keep_one_identification_per_user_per_observation(self, keep_index=0):
         """ Select one identification per user per observation.
         keep_index = 0 for the first identification, -1 for the last identification.
         """
 
-        # group the identifications by observation ids
-        ob_id_to_idens = {ob['id'] : [] for ob in self.observations}
-        for iden in self.identifications:
-            ob_id_to_idens[iden['observation_id']].append(iden)
+        ob_id_to_idens = self._index_idens_by_ob()
 
         iden_ids_to_keep = set()
         for ob_id, idens in ob_id_to_idens.items():
             # group the identifications by user and process them individually
-            user_id_to_idens = {}
+            user_id_to_idens = defaultdict(list)
             for identification in idens:
-                user_id = identification['user_id']
-                user_id_to_idens.setdefault(user_id, [])
-                user_id_to_idens[user_id].append(identification)
-
-            for user_id in user_id_to_idens:
-                user_idens = user_id_to_idens[user_id]
+                user_id_to_idens[identification['user_id']].append(identification)
 
+            for user_idens in user_id_to_idens.values():
                 # Sort the identifications by time
-                for identification in user_idens:
-                    created_at = identification['created_at']
-                    try:
-                        cat = datetime.datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S %Z')
-                    except:
-                        try:
-                            cat = datetime.datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S.%f')
-                        except:
-                            cat = datetime.datetime.strptime(created_at, '%Y-%m-%d %H:%M:%S')
-                    identification['time'] = cat
-                user_idens.sort(key=lambda x: x['time'])
+                user_idens.sort(key=lambda x: _parse_dt(x['created_at']))
 
                 iden_ids_to_keep.add(user_idens[keep_index]['id'])
 
-        idens_to_keep = [iden for iden in self.identifications if iden['id'] in iden_ids_to_keep]
-        self.identifications = idens_to_keep
-        self.iden_id_to_iden = {iden['id'] : iden for iden in self.identifications}
+        self.iden_id_to_iden = {iden_id : iden for iden_id, iden in self.iden_id_to_iden.items()
+                                if iden_id in iden_ids_to_keep}
+        self._ob_id_to_idens = None
     
     def keep_current_identifications(self):
         """ Keep only the current identifications.
         """
 
-        idens_to_keep = [iden for iden in self.identifications if iden['current'] == True]
-        self.identifications = idens_to_keep
-        self.iden_id_to_iden = {iden['id'] : iden for iden in self.identifications}
+        self.iden_id_to_iden = {iden_id : iden for iden_id, iden in self.iden_id_to_iden.items()
+                                if iden['current'] == True}
+        self._ob_id_to_idens = None
 
-        # Lets make sure that each identification for each observation is
-        # coming from a unique worker.
-        ob_id_to_idens = {ob['id'] : [] for ob in self.observations}
-        for iden in self.identifications:
-            ob_id_to_idens[iden['observation_id']].append(iden)
-        for ob_id, idens in ob_id_to_idens.items():
-            if len(set([iden['user_id'] for iden in idens])) != len(idens):
-                print("ERROR: observation %s has multiple identifications from the same user" % (ob_id,))
-                assert False
+        self._check_one_identification_per_user()
 
     def remove_ids_on_root(self):
         """ Keep only the identifications not on the root.
         """
         
         root = [d for d in self.taxa if d.get('key') == '0'][0]['taxon_id']
-        idens_to_keep = [iden for iden in self.identifications if iden['taxon_id'] != root]
-        self.identifications = idens_to_keep
-        self.iden_id_to_iden = {iden['id'] : iden for iden in self.identifications}
+        self.iden_id_to_iden = {iden_id : iden for iden_id, iden in self.iden_id_to_iden.items()
+                                if iden['taxon_id'] != root}
+        self._ob_id_to_idens = None
 
-        # Lets make sure that each identification for each observation is
-        # coming from a unique worker.
-        ob_id_to_idens = {ob['id'] : [] for ob in self.observations}
-        for iden in self.identifications:
-            ob_id_to_idens[iden['observation_id']].append(iden)
-        for ob_id, idens in ob_id_to_idens.items():
-            if len(set([iden['user_id'] for iden in idens])) != len(idens):
-                print("ERROR: observation %s has multiple identifications from the same user" % (ob_id,))
-                assert False
+        self._check_one_identification_per_user()
     
     def enforce_min_identifications(self, min_identifications=1):
         """ Remove observations that have less than `min_identifications`.
         """
 
-        ob_id_to_idens = {ob['id'] : [] for ob in self.observations}
-        for iden in self.identifications:
-            ob_id_to_idens[iden['observation_id']].append(iden)
+        if self._ob_id_to_idens is not None:
+            ob_id_to_num_idens = {ob_id : len(idens) for ob_id, idens in self._ob_id_to_idens.items()}
+        else:
+            # Only the counts are needed, so don't build the index for them
+            ob_id_to_num_idens = Counter(iden['observation_id'] for iden in self.iden_id_to_iden.values())
 
-        ob_ids_to_keep = set()
-        for ob_id, idens in ob_id_to_idens.items():
-            if len(idens) >= min_identifications:
-                ob_ids_to_keep.add(ob_id)
+        # Observations without identifications are not counted
+        ob_ids_to_keep = {ob_id for ob_id in self.ob_id_to_ob
+                          if ob_id_to_num_idens.get(ob_id, 0) >= min_identifications}
 
-        obs_to_keep = [ob for ob in self.observations if ob['id'] in ob_ids_to_keep]
-        self.observations = obs_to_keep
-        self.ob_id_to_ob = {ob['id'] : ob for ob in self.observations}
-
-        idens_to_keep = [iden for iden in self.identifications if iden['observation_id'] in self.ob_id_to_ob]
-        self.identifications = idens_to_keep
-        self.iden_id_to_iden = {iden['id'] : iden for iden in self.identifications}
+        self._keep_observations(ob_ids_to_keep)
 
     def enforce_max_observations(self, max_observations=None):
         if max_observations is None:
             return
 
-        if max_observations >= len(self.observations):
+        if max_observations >= len(self.ob_id_to_ob):
             return
 
-        # Randomly pick observations to keep
-        ob_ids = [ob['id'] for ob in self.observations]
-        ob_ids_to_keep = random.sample(ob_ids, max_observations)
-        obs_to_keep = [ob for ob in self.observations if ob['id'] in ob_ids_to_keep]
-        self.observations = obs_to_keep
-        self.ob_id_to_ob = {ob['id'] : ob for ob in self.observations}
-
-        idens_to_keep = [iden for iden in self.identifications if iden['observation_id'] in self.ob_id_to_ob]
-        self.identifications = idens_to_keep
-        self.iden_id_to_iden = {iden['id'] : iden for iden in self.identifications}
+        # Randomly pick observations to keep. Sampling the indices picks the
+        # same observations as sampling the ids, and gives a set directly.
+        ob_ids = list(self.ob_id_to_ob)
+        ob_ids_to_keep = {ob_ids[i] for i in random.sample(range(len(ob_ids)), max_observations)}
+        self._keep_observations(ob_ids_to_keep)
     
-    def create_dataset(self, leaf_taxa_priors):
+    def _create_dataset_without_annos(self, leaf_taxa_priors):
+        """ Create the dataset, workers and images parts of the dataset.
+        """
+
+        # The taxon ids are already ints, see `TAXONOMY_COLUMN_TYPES`
+        taxon_id_to_class_label = {d['taxon_id'] : d['key'] for d in self.taxa}
 
-        taxon_id_to_class_label = {}
-        for d in self.taxa:
-            taxon_id_to_class_label[int(d['taxon_id'])] = d['key']
-            
         taxonomy = []
         for item in self.taxa:
             new_item = {'parent': item['parent'], 'key': item['key'], 'data': {'prob': item['prob']}}
@@ -226,36 +309,71 @@ class iNaturalistDataset():
                 'urls' : [""]
             }
 
-        annos = []
-        for iden in self.identifications:
+        return {
+            'dataset' : dataset,
+            'workers' : workers,
+            'images' : images
+        }
+
+    def _iter_annos(self):
+        """ Yield the annos of the dataset, one per identification.
+        """
+
+        for iden in self.iden_id_to_iden.values():
 
-            taxon_id = int(iden['taxon_id'])
-            if taxon_id in taxon_id_to_class_label:
-                worker_label = taxon_id_to_class_label[taxon_id]
-            else:
+            taxon_id = iden['taxon_id']
+            if taxon_id not in self.taxon_id_to_taxon:
                 assert False
 
-            annos.append({
+            yield {
                 'anno' : {
                     'gtype' : 'multiclass',
                     'label' : str(iden['label']), #str(worker_label), #iden['label']
-                    'taxon_id' : int(iden['taxon_id'])
+                    'taxon_id' : taxon_id
                 },
                 'image_id' : iden['observation_id'],
                 'worker_id' : iden['user_id'],
                 'created_at' : iden['created_at'],
                 'id' : iden['id']
-            })
+            }
 
-        dataset = {
-            'dataset' : dataset,
-            'workers' : workers,
-            'images' : images,
-            'annos' : annos
-        }
+    def create_dataset(self, leaf_taxa_priors):
 
+        dataset = self._create_dataset_without_annos(leaf_taxa_priors)
+        dataset['annos'] = list(self._iter_annos())
         return dataset
 
+    def dump_dataset(self, leaf_taxa_priors, path, indent=None):
+        """ Save the dataset from `create_dataset` to a json file. The annos are
+        serialized and written one at a time, so the full annos list and its json
+        string are never in memory.
+        """
+
+        dataset = self._create_dataset_without_annos(leaf_taxa_priors)
+        sep = b',\n' if indent else b','
+        with open(path, 'wb') as f:
+            f.write(b'{')
+            for key, value in dataset.items():
+                f.write(dumps_json(key) + b':' + dumps_json(value, indent) + sep)
+            f.write(b'"annos":[')
+            for i, anno in enumerate(self._iter_annos()):
+                if i > 0:
+                    f.write(sep)
+                f.write(dumps_json(anno, indent))
+            f.write(b']}')
+
+def dumps_json(obj, indent=None):
+    """ Serialize `obj` to json bytes, using orjson when it is available.
+    orjson only supports an indent of 2, any `indent` turns it on.
+    """
+    if orjson is not None:
+        # the datasets are keyed by integer ids
+        option = orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+    return json.dumps(obj, indent=indent, ensure_ascii=False).encode('utf-8')
+
 def parse_args():
 
     parser = argparse.ArgumentParser(description='Create a dataset for crowdsourcing.')
@@ -286,58 +404,35 @@ def main():
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    with open(os.path.join(archive_dir, 'taxonomy.csv'), 'r') as f:
-        reader = csv.DictReader(f)
-        taxonomy = []
-        for row in reader:
-            for key, value in row.items():
-                if key != "parent" and key != "key":
-                    if value.isdigit():
-                        row[key] = int(value)
-                    else:
-                        try:
-                            row[key] = float(value)
-                        except ValueError:
-                            pass
-            taxonomy.append(row)
-
-    with open(os.path.join(archive_dir, 'identifications.csv'), 'r') as f:
-        reader = csv.DictReader(f)
-        identifications = []
-        for row in reader:
-            if row['label'] != '0':
-                identifications.append(row)
-
-    for d in identifications:
-        for k, v in d.items():
-            if v == 'true':
-                d[k] = True
-
-    for d in taxonomy:
-        for k, v in d.items():
-            if v == '':
-                d[k] = None
-    
-    observation_ids = {d['observation_id'] for d in identifications}
-    users = {d['user_id'] for d in identifications}
-    observations = [{'id': observation_id,
-      'user_id': None,
-      'community_taxon_id': None,
-      'quality_grade': None,
-      'created_at': None,
-      'latitude': None,
-      'longitude': None} for observation_id in observation_ids]
-    observation_photos = [{'id': observation_id, 'native_original_image_url': None} for observation_id in observation_ids]
-    
+    taxonomy = list(read_csv(os.path.join(archive_dir, 'taxonomy.csv'), TAXONOMY_COLUMN_TYPES))
+
+    # Collect the observation and user ids while streaming the identifications
+    identifications = []
+    observation_ids = set()
+    users = set()
+    for row in read_csv(os.path.join(archive_dir, 'identifications.csv'), IDENTIFICATION_COLUMN_TYPES):
+        if row['label'] != '0':
+            identifications.append(row)
+            observation_ids.add(row['observation_id'])
+            users.add(row['user_id'])
+
+    # Check the data once here rather than in each of the dataset builds.
+    checked_inat = iNaturalistDataset(observation_stubs(observation_ids), observation_photo_stubs(observation_ids),
+                                      identifications, taxonomy, users)
+    identifications = checked_inat.identifications
+    del checked_inat
+
     # Build the observation label prediction dataset
-    ob_inat = iNaturalistDataset(observations, observation_photos, identifications, taxonomy, users)
+    ob_inat = iNaturalistDataset(observation_stubs(observation_ids), observation_photo_stubs(observation_ids),
+                                 identifications, taxonomy, users, validate=False)
     ob_inat.keep_current_identifications()
     ob_inat.enforce_min_identifications(min_identifications=2)
     ob_inat.enforce_max_observations(args.max_observations)
-    ob_ids = [ob['id'] for ob in ob_inat.observations] # Make sure the worker dataset has the same obs
+    ob_ids = frozenset(ob_inat.ob_id_to_ob) # Make sure the worker dataset has the same obs
     
     # Build the worker skill prediction dataset
-    worker_inat = iNaturalistDataset(observations, observation_photos, identifications, taxonomy, users)
+    worker_inat = iNaturalistDataset(observation_stubs(observation_ids), observation_photo_stubs(observation_ids),
+                                     identifications, taxonomy, users, validate=False)
     worker_inat.keep_specific_observations(ob_ids)
     worker_inat.keep_one_identification_per_user_per_observation(keep_index=0)
     worker_inat.enforce_min_identifications(min_identifications=2)
@@ -347,28 +442,22 @@ def main():
     for d in ob_inat.taxa:
         if d['leaf'] == 1:
             taxa_priors[int(d['key'])] = float(d['prob'])
-    ob_label_pred_dataset = ob_inat.create_dataset(taxa_priors)
-    
-    label_pred_output_path = os.path.join(output_dir, 'observation_label_pred_dataset.json')
-    with open(label_pred_output_path, 'w') as f:
-        json.dump(ob_label_pred_dataset, f)
 
-    worker_skill_pred_dataset = worker_inat.create_dataset(taxa_priors)
+    label_pred_output_path = os.path.join(output_dir, 'observation_label_pred_dataset.json')
+    ob_inat.dump_dataset(taxa_priors, label_pred_output_path)
 
     worker_skill_pred_output_path = os.path.join(output_dir, 'worker_skill_pred_dataset.json')
-    with open(worker_skill_pred_output_path, 'w') as f:
-        json.dump(worker_skill_pred_dataset, f, indent=4, ensure_ascii=False)
+    worker_inat.dump_dataset(taxa_priors, worker_skill_pred_output_path, indent=4)
         
     # Build a "testing" dataset.
-    inat = iNaturalistDataset(observations, observation_photos, identifications, taxonomy, users)
+    inat = iNaturalistDataset(observation_stubs(observation_ids), observation_photo_stubs(observation_ids),
+                              identifications, taxonomy, users, validate=False)
     inat.keep_current_identifications()
     inat.enforce_min_identifications(min_identifications=1)
     inat.enforce_max_observations(args.max_observations)
-    test_dataset = inat.create_dataset(taxa_priors)
 
     test_output_path = os.path.join(output_dir, 'test_dataset.json')
-    with open(test_output_path, 'w') as f:
-        json.dump(test_dataset, f)
+    inat.dump_dataset(taxa_priors, test_output_path)
 
 if __name__ == '__main__':
     main()
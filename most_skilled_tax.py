@@ -1,6 +1,7 @@
 from __future__ import absolute_import, division, print_function
 
 import argparse
+from collections import defaultdict
 import csv
 import json
 import os
@@ -24,32 +25,32 @@ def parse_args():
     args = parser.parse_args()
     return args
 
-def only_same_number(lst):
-    if len(lst) == 0:
-        return False
-    return all(elem == lst[0] for elem in lst)
-
-def print_list(list, indent=0):
-    # first print all nodes with no parent
-    for node in list:
-        if node['parent'] is None:
-            print(" " * indent + str(node['taxon_id']) + ", max: " + 
+def format_node(node, indent):
+    return (" " * indent + str(node['taxon_id']) + ", max: " + 
               str(node['most_skilled']) + " (" + 
               (str(round(node['most_skilled_val'], 4)) if node['most_skilled_val'] is not None else "") + "), min: " + 
               str(node['least_skilled']) + " (" + 
               (str(round(node['least_skilled_val'], 4)) if node['least_skilled_val'] is not None else "") + ")")
-            print_children(list, node['label'], indent+2)
 
-def print_children(list, parent_key, indent):
-    # print all children of the given parent recursively
-    for node in list:
-        if node['parent'] == parent_key:
-            print(" " * indent + str(node['taxon_id']) + ", max: " + 
-              str(node['most_skilled']) + " (" + 
-              (str(round(node['most_skilled_val'], 4)) if node['most_skilled_val'] is not None else "") + "), min: " + 
-              str(node['least_skilled']) + " (" + 
-              (str(round(node['least_skilled_val'], 4)) if node['least_skilled_val'] is not None else "") + ")")
-            print_children(list, node['label'], indent+2)
+def print_list(nodes, indent=0):
+    # Index the nodes by their parent once, rather than scanning the
+    # whole list for the children of every node
+    parent_to_children = defaultdict(list)
+    for node in nodes:
+        parent_to_children[node['parent']].append(node)
+
+    # Walk the tree depth first, starting with the nodes with no parent. The
+    # children are pushed in reverse so that they come off the stack in order.
+    lines = []
+    stack = [(node, indent) for node in reversed(parent_to_children.get(None, []))]
+    while stack:
+        node, node_indent = stack.pop()
+        lines.append(format_node(node, node_indent))
+        for child in reversed(parent_to_children.get(node['label'], [])):
+            stack.append((child, node_indent + 2))
+
+    if lines:
+        sys.stdout.write('\n'.join(lines) + '\n')
 
 
 def main():
@@ -93,6 +94,11 @@ def main():
 
     label_to_inat_taxon_id = {v : k for k, v in inat_taxon_id_to_class_label.items()}
     
+    # The workers' skills don't change, so gather them into a
+    # [num workers x num skills] matrix once
+    worker_ids = list(model.workers)
+    skills = np.vstack([model.workers[worker_id].skill_vector for worker_id in worker_ids])
+
     most_skill = []
     for entry in model.taxonomy.inner_nodes():
         label = entry.key
@@ -101,21 +107,18 @@ def main():
         z_node_list = model.root_to_node_path_list[z_integer_id]
         z_parent_node = z_node_list[len(z_node_list)-2]
         skill_vector_index = model.internal_node_integer_id_to_skill_vector_index[z_parent_node]
-        res = {}
-        for worker_id in list(model.workers.keys()):
-            worker = model.workers[worker_id]
-            skill = worker.skill_vector[skill_vector_index]
-            res[worker_id] = skill
-        if only_same_number(list(res.values())):
+        worker_skills = skills[:, skill_vector_index]
+        if np.ptp(worker_skills) == 0:
             max_val = None
             max_key = None
             min_val = None
             min_key = None
         else:
-            max_val = max(res.values())
-            max_key = [k for k, v in res.items() if v == max_val][0]
-            min_val = min(res.values())
-            min_key = [k for k, v in res.items() if v == min_val][0]
+            # argmax / argmin return the first worker with the extreme skill
+            max_index = worker_skills.argmax()
+            min_index = worker_skills.argmin()
+            max_key, max_val = worker_ids[max_index], worker_skills[max_index]
+            min_key, min_val = worker_ids[min_index], worker_skills[min_index]
         if label == '0':
             z_parent_node = None
         if label == 0:
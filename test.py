@@ -14,8 +14,19 @@ sys.path.append('..')  # Add the sibling directory to the module search path
 
 from crowdsourcing.annotations.classification import multiclass_single_binomial_nt as MSB
 
+# Time of the last progress bar redraw, see `progress_bar`
+_progress_bar_last_write = 0.
+
 # https://gist.github.com/vladignatyev/06860ec2040cb497f0f3
-def progress_bar(count, total, status=''):
+def progress_bar(count, total, status='', min_interval=0.25):
+    # Only redraw every `min_interval` seconds (but always draw the start and the end)
+    # so that we don't flush stdout on every call.
+    global _progress_bar_last_write
+    now = time.monotonic()
+    if 0 < count < total and now - _progress_bar_last_write < min_interval:
+        return
+    _progress_bar_last_write = now
+
     bar_len = 60
     filled_len = int(round(bar_len * count / float(total)))
 
@@ -88,12 +99,12 @@ def test(model_path, dataset_path, output_dir, verification_task=False):
     s = time.time()
 
     # Predict the image labels
+    # NOTE: `predict_true_labels` is implemented per image by the crowdsourcing
+    # package, so this loop can't be batched from here.
     total_images = len(test_dataset.images)
-    i = 0
-    progress_bar(i, total_images)
-    for image in test_dataset.images.values():
+    progress_bar(0, total_images)
+    for i, image in enumerate(test_dataset.images.values(), 1):
         image.predict_true_labels(avoid_if_finished=False)
-        i += 1
         if i % 1000 == 0:
             progress_bar(i, total_images, "%d images finished" % (i,))
     print()
@@ -107,13 +118,18 @@ def test(model_path, dataset_path, output_dir, verification_task=False):
     print()
     s = time.time()
 
+    # Map the class labels back to inat taxon ids, used by the csv and sequence of events files
+    if hasattr(test_dataset, 'inat_taxon_id_to_class_label'):
+        class_label_to_inat_taxon_id = {v : k for k, v in test_dataset.inat_taxon_id_to_class_label.items()}
+    else:
+        class_label_to_inat_taxon_id = None
+
     # Save the risks
     image_risks = [(image_id, image.risk) for image_id, image in test_dataset.images.items()]
     image_risks.sort(key=lambda x: x[1])
     image_risks.reverse()
     with open(os.path.join(output_dir, 'observation_risks.txt'), 'w') as f:
-      for image_id, risk in image_risks:
-        print("%s\t%0.5f" % (image_id, risk), file=f)
+      f.writelines("%s\t%0.5f\n" % (image_id, risk) for image_id, risk in image_risks)
     with open(os.path.join(output_dir, 'observation_risks.json'), 'w') as f:
       json.dump(image_risks, f)
 
@@ -130,8 +146,7 @@ def test(model_path, dataset_path, output_dir, verification_task=False):
     # Make a csv file that contains the observation url, the risk, and identification count.
     ob_url_str = 'https://www.inaturalist.org/observations/%s'
 
-    if hasattr(test_dataset, 'inat_taxon_id_to_class_label'):
-        class_label_to_inat_taxon_id = {v : k for k, v in test_dataset.inat_taxon_id_to_class_label.items()}
+    if class_label_to_inat_taxon_id is not None:
         header = ["Observation ID", "Risk", "Pred Label", "Number of Identifications", "URL"]
         image_data = [(image_id, image.risk, class_label_to_inat_taxon_id[image.y.label], len(image.z), ob_url_str % (image_id,))
                       for image_id, image in test_dataset.images.items()]
@@ -150,32 +165,32 @@ def test(model_path, dataset_path, output_dir, verification_task=False):
 
 
     # Make a file that prints out the sequence of events for each observations.
-    if hasattr(test_dataset, 'inat_taxon_id_to_class_label'):
-        class_label_to_inat_taxon_id = {v : k for k, v in test_dataset.inat_taxon_id_to_class_label.items()}
+    if class_label_to_inat_taxon_id is not None:
+        lines = ["[Image ID] => (Worker ID, Prob Correct, <Prob Trust>, Taxon ID, Prior Taxon Prob) => ...  ==> [Predicted Taxon ID, Risk]"]
+        # use the same order as the csv file
+        for image_datum in image_data:
+            image_id = image_datum[0]
+            image = test_dataset.images[image_id]
+
+            parts = ["[%s]" % (image_id,)]
+            for anno in image.z.values():
+                worker = anno.worker
+                taxon_id = class_label_to_inat_taxon_id[anno.label]
+                taxon_prior = test_dataset.class_probs[anno.label]
+                # => (worker_id, prob_correct, <prob_trust>, taxon_id, taxon_prior)
+                if verification_task:
+                    parts.append(" => (%s, %0.3f, %0.3f, %s, %0.4f)" % (worker.id, worker.prob_correct, worker.prob_trust, taxon_id, taxon_prior))
+                else:
+                    parts.append(" => (%s, %0.3f, %s, %0.4f)" % (worker.id, worker.prob_correct, taxon_id, taxon_prior))
+
+            # ==> (predicted label, risk)
+            pred_taxon_id = class_label_to_inat_taxon_id[image.y.label]
+            parts.append(" ==> [%s, %0.3f]" % (pred_taxon_id, image.risk))
+
+            lines.append(''.join(parts))
 
         with open(os.path.join(output_dir, 'observation_seq_events.txt'), 'w') as f:
-            print("[Image ID] => (Worker ID, Prob Correct, <Prob Trust>, Taxon ID, Prior Taxon Prob) => ...  ==> [Predicted Taxon ID, Risk]", file=f)
-            # use the same order as the csv file
-            for i in range(len(image_data)):
-                image_id = image_data[i][0]
-                image = test_dataset.images[image_id]
-
-                seq_str = "[%s]" % (image_id,)
-                for anno in image.z.values():
-                    worker = anno.worker
-                    taxon_id = class_label_to_inat_taxon_id[anno.label]
-                    taxon_prior = test_dataset.class_probs[anno.label]
-                    # => (worker_id, label, prob_correct, prob_trust)
-                    if verification_task:
-                        seq_str += " => (%s, %0.3f, %0.3f, %s, %0.4f)" % (worker.id, worker.prob_correct, worker.prob_trust, taxon_id, taxon_prior)
-                    else:
-                        seq_str += " => (%s, %s, %0.3f)" % (worker.id, worker.prob_correct, taxon_id, taxon_prior)
-
-                # ==> (predicted label, risk)
-                pred_taxon_id = class_label_to_inat_taxon_id[image.y.label]
-                seq_str += " ==> [%s, %0.3f]" % (pred_taxon_id, image.risk)
-
-                print(seq_str, file=f)
+            f.write('\n'.join(lines) + '\n')
 
 
     e = time.time()